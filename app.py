@@ -1,14 +1,19 @@
 import os
+import io
 import csv
+import html
+import uuid
 import asyncio
+import hashlib
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional, Union
 
-import requests
+import httpx
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.responses import FileResponse, PlainTextResponse
+from pydantic import BaseModel
 
-from qwen_adapter import QwenImageEdit
+from qwen_adapter import CACHE_PRUNE_EVERY, QwenImageEdit, decode_image, prune_cache
 
 # --------------------
 # Configuration
@@ -17,14 +22,39 @@ MODEL_ID = os.environ.get("MODEL_ID", "/opt/models/Qwen-Image-Edit")
 OUTPUT_DIR = Path(os.environ.get("OUTPUT_DIR", "/app/outputs"))
 QUEUE_DIR = Path(os.environ.get("QUEUE_DIR", "/app/queue"))
 CSV_INBOX = Path(os.environ.get("CSV_INBOX", str(QUEUE_DIR / "inbox.csv")))
+CSV_CURSOR = QUEUE_DIR / "cursor"  # byte offset of the first unprocessed inbox row
+CSV_FAILED = QUEUE_DIR / "failed.csv"
+CSV_HEADER = "image_url,prompt,directory"
 CSV_SECRET = os.environ.get("CSV_SECRET", "")
+# queued rows use a fixed seed, so a retried or duplicated row reproduces its output and
+# is served from the output cache instead of re-running diffusion
+CSV_SEED = int(os.environ.get("CSV_SEED", "42"))
 MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENCY", "1"))
+MAX_BATCH = int(os.environ.get("MAX_BATCH", "4"))
+OUTPUT_FORMAT = os.environ.get("OUTPUT_FORMAT", "webp").lower()
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))
+# size cap for each of the CSV-download and finished-output caches; 0 disables both
+MAX_CACHE_BYTES = int(os.environ.get("MAX_CACHE_BYTES", str(10 * 1024**3)))
+IMAGE_CACHE = QUEUE_DIR / "image_cache"
+OUTPUT_CACHE = OUTPUT_DIR / ".cache"
+# "WxH,WxH,..." input sizes to run once at startup (compiles graphs); empty disables
+WARMUP_SIZES = [
+    tuple(int(v) for v in s.split("x"))
+    for s in os.environ.get("WARMUP_SIZES", "1024x1024").split(",")
+    if s.strip()
+]
+# prompt-length buckets (PROMPT_BUCKET tokens each) compiled per warm-up size; longer
+# prompts still work, they just run eager
+WARMUP_PROMPT_BUCKETS = int(os.environ.get("WARMUP_PROMPT_BUCKETS", "2"))
 
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 QUEUE_DIR.mkdir(parents=True, exist_ok=True)
+IMAGE_CACHE.mkdir(parents=True, exist_ok=True)
 CSV_INBOX.parent.mkdir(parents=True, exist_ok=True)
 if not CSV_INBOX.exists():
-    CSV_INBOX.write_text("image_url,prompt,directory\n")
+    CSV_INBOX.write_text(CSV_HEADER + "\n")
+
+MEDIA_TYPES = {"webp": "image/webp", "png": "image/png", "jpg": "image/jpeg", "jpeg": "image/jpeg"}
 
 # --------------------
 # Init FastAPI
@@ -33,24 +63,51 @@ app = FastAPI(title="Qwen Image Edit API")
 
 qwen: Optional[QwenImageEdit] = None
 _worker_task: Optional[asyncio.Task] = None
-_csv_lock = asyncio.Lock()
+_http: Optional[httpx.AsyncClient] = None
+_inbox_fd: Optional[int] = None
+_image_cache_writes = 0
 
 
 # --------------------
 # Startup / Shutdown
 # --------------------
 @app.on_event("startup")
-def _startup():
-    global qwen, _worker_task
-    qwen = QwenImageEdit(backend="local", model_id=MODEL_ID, device="cuda")
+async def _startup():
+    global qwen, _worker_task, _http, _inbox_fd
+    # O_APPEND writes land atomically at the end, so appends need no lock
+    _inbox_fd = os.open(CSV_INBOX, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    _http = httpx.AsyncClient(
+        http2=True,
+        follow_redirects=True,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+        timeout=20,
+    )
+    qwen = QwenImageEdit(
+        backend="local",
+        model_id=MODEL_ID,
+        device="cuda",
+        output_format=OUTPUT_FORMAT,
+        max_concurrency=MAX_CONCURRENCY,
+        cache_dir=OUTPUT_CACHE,
+        cache_bytes=MAX_CACHE_BYTES,
+    )
+    await qwen.warmup(
+        WARMUP_SIZES, sorted({1, MAX_BATCH}), QUEUE_DIR / "warmup", WARMUP_PROMPT_BUCKETS
+    )
     _worker_task = asyncio.create_task(_csv_worker())
 
 
 @app.on_event("shutdown")
-def _shutdown():
+async def _shutdown():
     global qwen, _worker_task
     if _worker_task:
         _worker_task.cancel()
+    if qwen:
+        qwen.close()
+    if _http:
+        await _http.aclose()
+    if _inbox_fd is not None:
+        os.close(_inbox_fd)
 
 
 # --------------------
@@ -70,19 +127,30 @@ async def edit_image(
     image_url: Optional[str] = Form(None),
     image_file: Optional[UploadFile] = File(None),
     directory: str = Form("manual"),
+    seed: Optional[int] = Form(None),
 ):
     if not qwen:
         raise HTTPException(status_code=500, detail="Model not initialized")
 
     # load image
     if image_url:
-        resp = requests.get(image_url, stream=True)
-        if resp.status_code != 200:
+        try:
+            data = await _fetch_image(image_url)
+        except Exception:
             raise HTTPException(status_code=400, detail="Failed to fetch image_url")
-        data = resp.content
+        if len(data) > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail="Image too large")
+        image = data
         filename = Path(image_url).name
     elif image_file:
-        data = await image_file.read()
+        if image_file.size is not None and image_file.size > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail="Image too large")
+        # decode straight from the spooled upload instead of copying it into memory first
+        loop = asyncio.get_running_loop()
+        try:
+            image = await loop.run_in_executor(None, decode_image, image_file.file)
+        except Exception:
+            raise HTTPException(status_code=400, detail="Invalid image_file")
         filename = image_file.filename
     else:
         raise HTTPException(status_code=400, detail="Either image_url or image_file is required")
@@ -90,8 +158,9 @@ async def edit_image(
     outdir = OUTPUT_DIR / "manual" / directory
     outdir.mkdir(parents=True, exist_ok=True)
 
-    outfile = await qwen.edit_async(prompt=prompt, image_bytes=data, outdir=outdir)
-    return FileResponse(outfile, media_type="image/png", filename=outfile.name)
+    outfile = await qwen.edit_async(prompt=prompt, image=image, outdir=outdir, seed=seed)
+    media_type = MEDIA_TYPES[outfile.suffix.lstrip(".")]
+    return FileResponse(outfile, media_type=media_type, filename=outfile.name)
 
 
 # --------------------
@@ -105,32 +174,105 @@ def _check_secret(secret: Optional[str]):
 @app.get("/csv")
 def get_csv(secret: Optional[str] = None):
     _check_secret(secret)
-    return PlainTextResponse(CSV_INBOX.read_text())
+    return PlainTextResponse(CSV_HEADER + "\n" + "".join(row + "\n" for row, _ in _read_pending()))
+
+
+class CsvRow(BaseModel):
+    image_url: str
+    prompt: str
+    directory: str
 
 
 @app.post("/csv/append")
-async def append_csv(lines: str, secret: Optional[str] = None):
+async def append_csv(rows: Union[CsvRow, List[CsvRow]], secret: Optional[str] = None):
     _check_secret(secret)
-    async with _csv_lock:
-        with CSV_INBOX.open("a") as f:
-            if not lines.endswith("\n"):
-                lines += "\n"
-            f.write(lines)
+    if isinstance(rows, CsvRow):
+        rows = [rows]
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    for row in rows:
+        # the journal is line-based, so keep each record on one line
+        writer.writerow([" ".join(v.splitlines()) for v in (row.image_url, row.prompt, row.directory)])
+    # write each request's rows as one buffer, off the event loop
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(None, _write_all, _inbox_fd, buf.getvalue().encode())
+    except OSError as e:
+        raise HTTPException(status_code=500, detail=f"Failed to append to inbox: {e.strerror}")
     return {"status": "ok"}
 
 
+def _write_all(fd: int, data: bytes):
+    # os.write may write less than asked (e.g. near a full disk); finish the record
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
 @app.get("/csv/ui")
 def csv_ui(secret: Optional[str] = None):
     _check_secret(secret)
-    rows = CSV_INBOX.read_text().strip().splitlines()
-    if not rows:
+    pending = _read_pending()
+    if not pending:
         return PlainTextResponse("Inbox empty")
 
-    html = ["<html><body><h2>CSV Inbox</h2><table border='1'>"]
-    for row in csv.reader(rows):
-        html.append("<tr>" + "".join(f"<td>{c}</td>" for c in row) + "</tr>")
-    html.append("</table></body></html>")
-    return PlainTextResponse("\n".join(html), media_type="text/html")
+    def _table_rows():
+        for cells in csv.reader([CSV_HEADER] + [row for row, _ in pending]):
+            yield "<tr>" + "".join(f"<td>{html.escape(c)}</td>" for c in cells) + "</tr>\n"
+
+    body = "".join(
+        [
+            "<html><body><h2>CSV Inbox</h2><table border='1'>\n",
+            *_table_rows(),
+            "</table></body></html>",
+        ]
+    )
+    return PlainTextResponse(body, media_type="text/html")
+
+
+# --------------------
+# Inbox journal
+# --------------------
+def _read_cursor() -> int:
+    try:
+        return int(CSV_CURSOR.read_text())
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def _write_cursor(offset: int):
+    tmp = CSV_CURSOR.with_suffix(".tmp")
+    tmp.write_text(str(offset))
+    os.replace(tmp, CSV_CURSOR)
+
+
+def _read_pending():
+    """Complete inbox rows after the cursor, as (row, byte offset just past the row)."""
+    offset = _read_cursor()
+    if offset > CSV_INBOX.stat().st_size:
+        offset = 0  # inbox was truncated or replaced
+    with CSV_INBOX.open("rb") as f:
+        f.seek(offset)
+        data = f.read()
+
+    pending = []
+    # the last piece is either empty or a row still being written
+    for line in data.split(b"\n")[:-1]:
+        offset += len(line) + 1
+        row = line.decode("utf-8", errors="replace").rstrip("\r")
+        if row and row != CSV_HEADER:
+            pending.append((row, offset))
+    return pending
+
+
+def _record_failed(rows):
+    if not rows:
+        return
+    new = not CSV_FAILED.exists()
+    with CSV_FAILED.open("a") as f:
+        if new:
+            f.write(CSV_HEADER + "\n")
+        f.write("".join(row + "\n" for row in rows))
 
 
 # --------------------
@@ -141,33 +283,117 @@ async def _csv_worker():
     while True:
         try:
             await asyncio.sleep(5)
-            async with _csv_lock:
-                lines = CSV_INBOX.read_text().strip().splitlines()
-                if len(lines) <= 1:
-                    continue  # header only or empty
-                header, *rows = lines
-
-                remaining = [header]
-                for row in rows:
-                    try:
-                        image_url, prompt, directory = row.split(",", 2)
-                    except Exception:
-                        continue
-                    try:
-                        resp = requests.get(image_url, stream=True, timeout=20)
-                        if resp.status_code != 200:
-                            raise RuntimeError(f"fetch failed {resp.status_code}")
-                        data = resp.content
-                        outdir = OUTPUT_DIR / directory
-                        outdir.mkdir(parents=True, exist_ok=True)
-                        await qwen.edit_async(prompt=prompt, image_bytes=data, outdir=outdir)
-                    except Exception as e:
-                        print("[csv_worker] failed:", row, e)
-                        remaining.append(row)
-
-                # overwrite inbox with any remaining
-                CSV_INBOX.write_text("\n".join(remaining) + "\n")
+            pending = _read_pending()
+            if not pending:
+                continue
+
+            jobs, job_ends, malformed = [], [], []
+            for row, end in pending:
+                cells = next(csv.reader([row]), [])
+                if len(cells) != 3:
+                    print("[csv_worker] malformed:", row)
+                    malformed.append(row)
+                    continue
+                image_url, prompt, directory = cells
+                jobs.append((row, image_url, prompt, directory))
+                job_ends.append(end)
+            _record_failed(malformed)
+
+            # download the next batch while the current one is on the GPU
+            batches = [
+                (jobs[i:i + MAX_BATCH], job_ends[i:i + MAX_BATCH][-1])
+                for i in range(0, len(jobs), MAX_BATCH)
+            ]
+            prefetch = asyncio.ensure_future(_fetch_batch(batches[0][0])) if batches else None
+            for n, (batch, end) in enumerate(batches):
+                fetched = await prefetch
+                if n + 1 < len(batches):
+                    prefetch = asyncio.ensure_future(_fetch_batch(batches[n + 1][0]))
+                _record_failed(await _run_csv_batch(batch, fetched))
+                _write_cursor(end)
+
+            # also step past any malformed rows at the tail
+            _write_cursor(pending[-1][1])
         except asyncio.CancelledError:
             break
         except Exception as e:
             print("[csv_worker] error:", e)
+
+
+async def _fetch_image(image_url: str, row: Optional[str] = None) -> bytes:
+    """Download `image_url`. Pass the inbox `row` to cache the bytes for retries of that row.
+
+    The cache is keyed by the whole row rather than the URL, so one-off edits and other
+    rows always see the URL's current content.
+    """
+    global _image_cache_writes
+    loop = asyncio.get_running_loop()
+    cache = row is not None and MAX_CACHE_BYTES > 0
+    if cache:
+        cached = IMAGE_CACHE / hashlib.sha256(row.encode()).hexdigest()
+        data = await loop.run_in_executor(None, _read_cached, cached)
+        if data is not None:
+            return data
+    resp = await _http.get(image_url)
+    if resp.status_code != 200:
+        raise RuntimeError(f"fetch failed {resp.status_code}")
+    # /api/edit answers oversized bodies with its own 413; queued rows fail here, uncached
+    if row is not None and len(resp.content) > MAX_UPLOAD_BYTES:
+        raise RuntimeError(f"image too large ({len(resp.content)} bytes)")
+    if cache:
+        _image_cache_writes += 1
+        prune = _image_cache_writes % CACHE_PRUNE_EVERY == 0
+        await loop.run_in_executor(None, _write_cached, cached, resp.content, prune)
+    return resp.content
+
+
+def _read_cached(path: Path) -> Optional[bytes]:
+    try:
+        data = path.read_bytes()
+        os.utime(path)  # mark as recently used for prune_cache
+        return data
+    except FileNotFoundError:
+        return None
+
+
+def _write_cached(path: Path, data: bytes, prune: bool):
+    tmp = path.with_name(f"{uuid.uuid4().hex}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+    if prune:
+        prune_cache(IMAGE_CACHE, MAX_CACHE_BYTES)
+
+
+async def _fetch_batch(jobs):
+    return await asyncio.gather(
+        *(_fetch_image(image_url, row) for row, image_url, _, _ in jobs),
+        return_exceptions=True,
+    )
+
+
+async def _run_csv_batch(jobs, fetched):
+    """Edit a batch of parsed rows whose images are in `fetched`; return the rows that failed."""
+    failed, ready = [], []
+    for (row, _, prompt, directory), data in zip(jobs, fetched):
+        if isinstance(data, Exception):
+            print("[csv_worker] failed:", row, data)
+            failed.append(row)
+        else:
+            ready.append((row, prompt, directory, data))
+    if not ready:
+        return failed
+
+    try:
+        await qwen.edit_batch_async(
+            prompts=[prompt for _, prompt, _, _ in ready],
+            images=[data for _, _, _, data in ready],
+            outdirs=[OUTPUT_DIR / directory for _, _, directory, _ in ready],
+            seed=CSV_SEED,
+            wait=False,  # let the next batch start while these are written
+            on_save_error=lambda i, _: _record_failed([ready[i][0]]),
+        )
+    except Exception as e:
+        rows = [row for row, _, _, _ in ready]
+        print("[csv_worker] batch failed:", rows, e)
+        failed += rows
+    return failed
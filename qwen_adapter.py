@@ -1,73 +1,221 @@
 import os
 import io
+import uuid
+import asyncio
+import shutil
+import hashlib
+import threading
+import contextlib
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional
+from typing import BinaryIO, Callable, Dict, List, Optional, Tuple, Union
 
+import numpy as np
 import torch
+from torch.nn.attention import SDPBackend, sdpa_kernel
 from PIL import Image
 
+try:
+    import pyvips  # multithreaded PNG encoder
+except ImportError:
+    pyvips = None
+
 from diffusers import (
     QwenImageEditPipeline,
     QwenImageTransformer2DModel,
     BitsAndBytesConfig as DBits,
 )
+from diffusers.pipelines.qwenimage.pipeline_qwenimage_edit import calculate_dimensions
 from transformers import (
     Qwen2_5_VLForConditionalGeneration,
     BitsAndBytesConfig as TBits,
 )
 
 
+# QwenImageEditPipeline resizes every input to roughly this many pixels
+TARGET_AREA = 1024 * 1024
+# keep this much headroom over the weights for activations before staying resident
+VRAM_HEADROOM = 1.2
+# rough loaded/on-disk size of bf16 weights after NF4 + double quant (norms and embeds stay bf16)
+NF4_RATIO = 0.3
+# caches are pruned once per this many writes rather than scanning the directory every time
+CACHE_PRUNE_EVERY = 32
+
+# never the O(N^2)-memory math kernel. When compiled, PROMPT_BUCKET padding means every
+# call carries a mask, so this is the mem-efficient kernel; flash only gets unmasked
+# calls, i.e. single prompts with USE_COMPILE=0 or PROMPT_BUCKET=0
+SDPA_BACKENDS = [SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION]
+
+# output extension -> (PIL format, save kwargs)
+SAVE_FORMATS = {
+    "webp": ("WEBP", dict(quality=92, method=4)),
+    "jpg": ("JPEG", dict(quality=92)),
+    "jpeg": ("JPEG", dict(quality=92)),
+    "png": ("PNG", dict(compress_level=3)),
+}
+
+
+# encoded image bytes, or an already decoded RGB image
+ImageInput = Union[bytes, Image.Image]
+
+
+def decode_image(src: Union[bytes, BinaryIO]) -> Image.Image:
+    """Decode to RGB, letting libjpeg downscale JPEGs close to the pipeline's target size."""
+    image = Image.open(io.BytesIO(src) if isinstance(src, bytes) else src)
+    width, height, _ = calculate_dimensions(TARGET_AREA, image.width / image.height)
+    # no-op for non-JPEG formats; for JPEG, decodes at the smallest DCT scale >= target
+    image.draft("RGB", (width, height))
+    # convert() copies even when the mode already matches; most inputs are RGB JPEGs
+    if image.mode != "RGB":
+        return image.convert("RGB")
+    image.load()  # decode here, not lazily on the GPU thread
+    return image
+
+
+def _digest(image: ImageInput) -> str:
+    data = image if isinstance(image, bytes) else image.tobytes()
+    return hashlib.sha256(data).hexdigest()
+
+
+def _host_bytes(module: torch.nn.Module) -> int:
+    """Bytes of `module` weights that still need to be moved onto the GPU."""
+    tensors = list(module.parameters()) + list(module.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors if t.device.type != "cuda")
+
+
+def _link_or_copy(src: Path, dst: Path):
+    try:
+        os.link(src, dst)
+    except OSError:  # other filesystem, or links unsupported
+        shutil.copyfile(src, dst)
+
+
+_prune_lock = threading.Lock()
+
+
+def prune_cache(directory: Path, max_bytes: int):
+    """Delete least recently used files until `directory` fits in `max_bytes`.
+
+    Returns at once if another thread is already pruning; in-flight "*.tmp" files are skipped.
+    """
+    if not _prune_lock.acquire(blocking=False):
+        return
+    try:
+        entries = []
+        for e in os.scandir(directory):
+            if e.name.endswith(".tmp"):
+                continue
+            try:
+                if e.is_file():
+                    st = e.stat()
+                    entries.append((st.st_atime, st.st_size, e.path))
+            except FileNotFoundError:  # evicted or replaced since the scan
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            Path(path).unlink(missing_ok=True)
+            total -= size
+    finally:
+        _prune_lock.release()
+
+
+def _disk_bytes(model_id: str, subfolder: str) -> Optional[int]:
+    """Size of a local component's safetensors shards, or None if not a local checkout."""
+    shards = list((Path(model_id) / subfolder).glob("*.safetensors"))
+    return sum(f.stat().st_size for f in shards) if shards else None
+
+
+def _pick_offload(free: int, core: int, full: int) -> str:
+    gib = 2**30
+    print(f"[offload] free={free / gib:.1f}GiB core={core / gib:.1f}GiB full={full / gib:.1f}GiB")
+    if free > VRAM_HEADROOM * full:
+        return "resident"
+    if free > VRAM_HEADROOM * core:
+        return "text_encoder"
+    return "model"
+
+
 class QwenImageEdit:
     def __init__(
         self,
         backend: str = "local",
         model_id: Optional[str] = None,
         device: str = "cuda",
+        output_format: str = "webp",
+        max_concurrency: int = 1,
+        cache_dir: Optional[Path] = None,
+        cache_bytes: int = 0,
     ):
+        if output_format not in SAVE_FORMATS:
+            raise ValueError(f"Unsupported output_format: {output_format}")
         self.backend = backend
+        self.output_format = output_format
         self.model_id = model_id or os.environ.get("MODEL_ID", "Qwen/Qwen-Image-Edit")
         self.device = device
+        # finished outputs by content key; a repeat of the same edit is a file copy
+        self.cache_dir = cache_dir if cache_bytes > 0 else None
+        self.cache_bytes = cache_bytes
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._cache_lock = threading.Lock()
+        self._cache_writes = 0
 
         torch_dtype = torch.bfloat16 if torch.cuda.is_available() else torch.float32
-        use_4bit = os.environ.get("USE_4BIT", "0") == "1"
+        use_4bit = os.environ.get("USE_4BIT", "1") == "1"
+        # text encoder cost is activation-bound, so it stays bf16 unless asked
+        use_4bit_te = os.environ.get("USE_4BIT_TEXT_ENCODER", "0") == "1"
+        use_compile = os.environ.get("USE_COMPILE", "1") == "1"
+        use_channels_last = os.environ.get("USE_CHANNELS_LAST", "1") == "1"
+        # bitsandbytes 4-bit kernels need CUDA on Turing (sm_75) or newer
+        if (use_4bit or use_4bit_te) and not (
+            torch.cuda.is_available() and torch.cuda.get_device_capability() >= (7, 5)
+        ):
+            print("[QwenImageEdit] 4-bit needs a CUDA GPU with compute capability >= 7.5; loading unquantized")
+            use_4bit = use_4bit_te = False
 
-        print(f"[QwenImageEdit] Loading model_id={self.model_id}, device={device}, 4bit={use_4bit}")
+        print(
+            f"[QwenImageEdit] Loading model_id={self.model_id}, device={device}, "
+            f"4bit={use_4bit}, 4bit_text_encoder={use_4bit_te}, compile={use_compile}"
+        )
 
+        # decide placement before loading so resident components go straight from the
+        # mmap'd safetensors onto the GPU instead of being staged in host RAM first
+        offload_mode = os.environ.get("OFFLOAD_MODE", "auto")
+        if offload_mode == "auto":
+            offload_mode = self._plan_offload_from_disk(use_4bit, use_4bit_te)
+        core_map = device if offload_mode in ("resident", "text_encoder") else None
+        te_map = device if offload_mode == "resident" else None
+
+        # one NF4 config for whichever components are 4-bit
         quant_args = dict(
             load_in_4bit=True,
             bnb_4bit_quant_type="nf4",
             bnb_4bit_compute_dtype=torch_dtype,
+            bnb_4bit_use_double_quant=True,
+            bnb_4bit_quant_storage=torch.uint8,
         )
 
         # transformer
-        if use_4bit:
-            transformer = QwenImageTransformer2DModel.from_pretrained(
-                self.model_id,
-                subfolder="transformer",
-                quantization_config=DBits(**quant_args),
-                torch_dtype=torch_dtype,
-            )
-        else:
-            transformer = QwenImageTransformer2DModel.from_pretrained(
-                self.model_id,
-                subfolder="transformer",
-                torch_dtype=torch_dtype,
-            )
+        transformer = QwenImageTransformer2DModel.from_pretrained(
+            self.model_id,
+            subfolder="transformer",
+            quantization_config=DBits(**quant_args) if use_4bit else None,
+            torch_dtype=torch_dtype,
+            device_map=core_map,
+        )
+        transformer.eval()
 
         # text encoder
-        if use_4bit:
-            text_encoder = Qwen2_5_VLForConditionalGeneration.from_pretrained(
-                self.model_id,
-                subfolder="text_encoder",
-                quantization_config=TBits(**quant_args),
-                torch_dtype=torch_dtype,
-            )
-        else:
-            text_encoder = Qwen2_5_VLForConditionalGeneration.from_pretrained(
-                self.model_id,
-                subfolder="text_encoder",
-                torch_dtype=torch_dtype,
-            )
+        text_encoder = Qwen2_5_VLForConditionalGeneration.from_pretrained(
+            self.model_id,
+            subfolder="text_encoder",
+            quantization_config=TBits(**quant_args) if use_4bit_te else None,
+            torch_dtype=torch_dtype,
+            device_map=te_map,
+        )
 
         # pipeline
         pipe = QwenImageEditPipeline.from_pretrained(
@@ -78,18 +226,248 @@ class QwenImageEdit:
         )
 
         # load LoRA (Lightning)
+        lora_loaded = False
         try:
             pipe.load_lora_weights(
                 "lightx2v/Qwen-Image-Lightning",
                 weight_name="Qwen-Image-Lightning-8steps-V1.1.safetensors",
             )
+            lora_loaded = True
             print("[LoRA] Loaded lightx2v/Qwen-Image-Lightning (8steps V1.1)")
         except Exception as e:
             print("[LoRA] Skipped:", e)
 
-        pipe.enable_model_cpu_offload()
+        # merge into the base weights so compiled graphs see plain layers; if that fails
+        # the adapter stays loaded and active, just unfused (slower, same output)
+        if lora_loaded:
+            try:
+                pipe.fuse_lora()
+                pipe.unload_lora_weights()
+                print("[LoRA] Fused into base weights")
+            except Exception as e:
+                print("[LoRA] Fuse failed, running unfused:", e)
+
+        # attention: Qwen's joint-attention processor dispatches through diffusers;
+        # e.g. ATTN_BACKEND=flash uses flash-attn (unmasked only, so MAX_BATCH=1
+        # and PROMPT_BUCKET=0)
+        attn_backend = os.environ.get("ATTN_BACKEND", "")
+        if attn_backend:
+            try:
+                pipe.transformer.set_attention_backend(attn_backend)
+                print(f"[attn] backend={attn_backend}")
+            except Exception as e:
+                print("[attn] backend skipped:", e)
+
+        # VAE: tile/slice decode caps peak VRAM at 1024^2 and for batches
+        pipe.vae.enable_tiling()
+        pipe.vae.enable_slicing()
+        # NHWC / NDHWC conv weights pick cuDNN's faster bf16 kernels, and activations follow
+        # the weight layout. The VAE mixes causal Conv3d with 2D resample/attention convs;
+        # the transformer is all Linear, so there is nothing to convert there.
+        if use_channels_last:
+            for m in pipe.vae.modules():
+                if isinstance(m, torch.nn.Conv3d):
+                    m.to(memory_format=torch.channels_last_3d)
+                elif isinstance(m, torch.nn.Conv2d):
+                    m.to(memory_format=torch.channels_last)
+
+        # all CUDA work runs on one dedicated thread so the event loop stays free;
+        # the semaphore bounds how many requests may queue for it
+        self._gpu_sem = asyncio.Semaphore(max_concurrency)
+        self._gpu_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gpu")
+        # WebP/PNG encoding happens here, off the GPU thread, so it can start the next batch
+        self._save_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="save")
+
+        # (prompt, image sha256) -> unpadded prompt embeddings [seq, dim], kept on device
+        self._prompt_cache: "OrderedDict[Tuple[str, str], torch.Tensor]" = OrderedDict()
+        self._prompt_cache_size = int(os.environ.get("PROMPT_CACHE_SIZE", "64"))
+
+        self.offload_mode = self._setup_offload(pipe, offload_mode)
+
+        # compile (artifacts persist via TORCHINDUCTOR_CACHE_DIR; first call per shape traces).
+        # reduce-overhead captures CUDA graphs, which need weights at fixed GPU addresses,
+        # so it is only the default when nothing is offloaded.
+        self._compiled = use_compile
+        # (width, height, batch, prompt length) shapes traced during warm-up; others run eager
+        self._graph_shapes = set()
+        # compiled graphs are specialized on the prompt-embedding length, so pad it up to a
+        # multiple of this many tokens (0 disables; flash attention needs it off, as padding
+        # always brings a mask)
+        self._prompt_bucket = int(os.environ.get("PROMPT_BUCKET", "128")) if use_compile else 0
+        if use_compile:
+            default_mode = "reduce-overhead" if self.offload_mode == "resident" else "default"
+            compile_mode = os.environ.get("COMPILE_MODE", default_mode)
+            pipe.transformer.compile(mode=compile_mode, dynamic=False)
+            pipe.vae.decode = torch.compile(pipe.vae.decode, mode=compile_mode, dynamic=False)
+            print(f"[compile] transformer + vae.decode, mode={compile_mode}")
+
         self.pipe = pipe
-        self.generator = torch.Generator(device=device).manual_seed(42)
+
+    # -------------------------
+    # Helpers
+    # -------------------------
+    def _plan_offload_from_disk(self, use_4bit: bool, use_4bit_te: bool) -> str:
+        """Pick the offload mode from on-disk weight sizes; "auto" defers to after loading."""
+        sizes = {
+            sub: _disk_bytes(self.model_id, sub) for sub in ("transformer", "vae", "text_encoder")
+        }
+        if None in sizes.values() or not torch.cuda.is_available():
+            return "auto"
+        free, _ = torch.cuda.mem_get_info()
+        core = sizes["transformer"] * (NF4_RATIO if use_4bit else 1) + sizes["vae"]
+        full = core + sizes["text_encoder"] * (NF4_RATIO if use_4bit_te else 1)
+        return _pick_offload(free, int(core), int(full))
+
+    def _setup_offload(self, pipe: QwenImageEditPipeline, mode: str) -> str:
+        """Place the pipeline components; returns the offload mode actually used.
+
+        resident:     everything stays on the GPU, no per-request PCIe traffic
+        text_encoder: transformer + VAE resident, text encoder visits the GPU per encode
+        model:        diffusers model CPU offload (lowest VRAM, slowest)
+        """
+        if mode == "auto":
+            if not torch.cuda.is_available():
+                mode = "resident"
+            else:
+                free, _ = torch.cuda.mem_get_info()
+                core = _host_bytes(pipe.transformer) + _host_bytes(pipe.vae)
+                mode = _pick_offload(free, core, core + _host_bytes(pipe.text_encoder))
+
+        if mode == "resident":
+            pipe.to(self.device)
+        elif mode == "text_encoder":
+            pipe.transformer.to(self.device)
+            pipe.vae.to(self.device)
+            pipe.text_encoder.to("cpu")
+            # keep the CPU-side encoder out of the pipeline between encodes so the pipeline
+            # never resolves its execution device (latents, image, vae.encode) to the CPU
+            self._text_encoder = pipe.text_encoder
+            pipe.text_encoder = None
+        elif mode == "model":
+            pipe.enable_model_cpu_offload()
+        else:
+            raise ValueError(f"Unknown OFFLOAD_MODE: {mode}")
+        print(f"[offload] mode={mode}")
+        return mode
+
+    def _encode_prompts(
+        self,
+        prompts: List[str],
+        images: List[Image.Image],
+        keys: List[Tuple[str, str]],
+        extra_buckets: int = 0,
+    ):
+        """Encode a group, reusing cached embeddings; returns (prompt_embeds, prompt_embeds_mask).
+
+        The Qwen2-VL encoder conditions on the image as well as the prompt, so entries
+        are keyed by both.
+        """
+        found: Dict[Tuple[str, str], torch.Tensor] = {}
+        for key in keys:
+            if key in self._prompt_cache:
+                self._prompt_cache.move_to_end(key)
+                found[key] = self._prompt_cache[key]
+
+        misses = [i for i, key in enumerate(keys) if key not in found]
+        if misses:
+            if self.offload_mode == "text_encoder":
+                self.pipe.text_encoder = self._text_encoder.to(self.device)
+            try:
+                embeds, mask = self.pipe.encode_prompt(
+                    prompt=[prompts[i] for i in misses],
+                    image=[images[i] for i in misses],
+                    device=self.device,
+                )
+            finally:
+                if self.offload_mode == "text_encoder":
+                    self._text_encoder.to("cpu")
+                    self.pipe.text_encoder = None
+            for j, i in enumerate(misses):
+                length = embeds.shape[1] if mask is None else int(mask[j].sum())
+                found[keys[i]] = embeds[j, :length].detach()
+                if self._prompt_cache_size > 0:
+                    self._prompt_cache[keys[i]] = found[keys[i]]
+            while len(self._prompt_cache) > self._prompt_cache_size:
+                self._prompt_cache.popitem(last=False)
+
+        # re-pad to a batch; padding goes at the end, matching encode_prompt
+        items = [found[key] for key in keys]
+        max_len = max(e.shape[0] for e in items)
+        if self._prompt_bucket:
+            # always round past the longest prompt so the mask is never all-ones (the pipeline
+            # would drop it to None, which is a different graph)
+            max_len = (max_len // self._prompt_bucket + 1 + extra_buckets) * self._prompt_bucket
+        embeds = torch.stack([torch.nn.functional.pad(e, (0, 0, 0, max_len - e.shape[0])) for e in items])
+        positions = torch.arange(max_len, device=embeds.device)
+        mask = torch.stack([(positions < e.shape[0]).long() for e in items])
+        return embeds, mask
+
+    def _new_outfile(self, outdir: Path) -> Path:
+        outdir.mkdir(parents=True, exist_ok=True)
+        return outdir / f"edit_{uuid.uuid4().hex[:12]}.{self.output_format}"
+
+    def _save(self, image: Image.Image, outdir: Path, key: Optional[str]) -> Tuple[Path, Future]:
+        """Pick the output path and hand the encode + write to the save pool."""
+        outfile = self._new_outfile(outdir)
+        return outfile, self._save_pool.submit(self._write_image, image, outfile, key)
+
+    def _write_image(self, image: Image.Image, outfile: Path, key: Optional[str]) -> Path:
+        if self.output_format == "png" and pyvips is not None:
+            pyvips.Image.new_from_array(np.asarray(image)).write_to_file(str(outfile), compression=3)
+        else:
+            fmt, kwargs = SAVE_FORMATS[self.output_format]
+            image.save(outfile, format=fmt, **kwargs)
+        if key and self.cache_dir:
+            self._cache_put(outfile, key)
+        return outfile
+
+    def _cache_put(self, outfile: Path, key: str):
+        # never write through an existing entry: it may be hard-linked to an earlier output
+        # (or being served), so stage under a temp name and swap the directory entry
+        tmp = self.cache_dir / f"{uuid.uuid4().hex}.tmp"
+        _link_or_copy(outfile, tmp)
+        os.replace(tmp, self._cache_path(key))
+        with self._cache_lock:
+            self._cache_writes += 1
+            prune = self._cache_writes % CACHE_PRUNE_EVERY == 0
+        if prune:
+            prune_cache(self.cache_dir, self.cache_bytes)
+
+    def _cache_path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.{self.output_format}"
+
+    def _cache_lookup(
+        self,
+        prompts: List[str],
+        digests: List[str],
+        outdirs: List[Path],
+        steps: int,
+        seed: Optional[int],
+    ) -> Tuple[List[Optional[str]], List[Optional[Path]]]:
+        """Content keys for each edit, and a fresh copy of the cached output where one exists.
+
+        Only seeded edits are cached; without a seed every call draws a new sample.
+        """
+        if not self.cache_dir or seed is None:
+            return [None] * len(prompts), [None] * len(prompts)
+        keys, hits = [], []
+        for prompt, digest, outdir in zip(prompts, digests, outdirs):
+            key = hashlib.sha256(f"{prompt}\0{digest}\0{seed}\0{steps}".encode()).hexdigest()
+            cached = self._cache_path(key)
+            outfile = self._new_outfile(outdir)
+            try:
+                shutil.copyfile(cached, outfile)
+                os.utime(cached)  # mark as recently used for prune_cache
+            except FileNotFoundError:
+                outfile = None
+            keys.append(key)
+            hits.append(outfile)
+        return keys, hits
+
+    def _generator(self, seed: Optional[int]) -> torch.Generator:
+        if seed is None:
+            seed = int.from_bytes(os.urandom(8), "little")
+        return torch.Generator(device=self.device).manual_seed(seed)
 
     # -------------------------
     # Public API
@@ -97,22 +475,181 @@ class QwenImageEdit:
     async def edit_async(
         self,
         prompt: str,
-        image_bytes: bytes,
+        image: ImageInput,
         outdir: Path,
         num_inference_steps: int = 8,
+        seed: Optional[int] = None,
     ) -> Path:
-        """Edit an image and save it to `outdir`, return path to file."""
-        outdir.mkdir(parents=True, exist_ok=True)
+        """Edit an image and save it to `outdir`, return path to file.
 
-        image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-
-        result = self.pipe(
-            prompt=prompt,
-            image=image,
+        Pass `seed` for a reproducible result; otherwise a random one is drawn.
+        """
+        outfiles = await self.edit_batch_async(
+            prompts=[prompt],
+            images=[image],
+            outdirs=[outdir],
             num_inference_steps=num_inference_steps,
-            generator=self.generator,
-        ).images[0]
+            seed=seed,
+        )
+        return outfiles[0]
 
-        outfile = outdir / f"edit_{torch.randint(0, 1_000_000, (1,)).item()}.png"
-        result.save(outfile)
-        return outfile
+    async def edit_batch_async(
+        self,
+        prompts: List[str],
+        images: List[ImageInput],
+        outdirs: List[Path],
+        num_inference_steps: int = 8,
+        seed: Optional[int] = None,
+        wait: bool = True,
+        on_save_error: Optional[Callable[[int, BaseException], None]] = None,
+    ) -> List[Path]:
+        """Edit several images, one pipeline call per output resolution.
+
+        Returns the output paths in input order. With `wait=False` the files are still
+        being written in the background when this returns; `close()` drains them, and a
+        failed write calls `on_save_error(input index, exception)` on the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        digests = await loop.run_in_executor(None, lambda: [_digest(i) for i in images])
+        keys, outfiles = await loop.run_in_executor(
+            None, self._cache_lookup, prompts, digests, outdirs, num_inference_steps, seed
+        )
+        miss = [i for i, outfile in enumerate(outfiles) if outfile is None]
+        if not miss:
+            return outfiles
+        # fetched bytes are decoded here too, so the GPU thread only ever sees PIL images
+        pending = [images[i] for i in miss]
+        decoded = await loop.run_in_executor(
+            None, lambda: [decode_image(i) if isinstance(i, bytes) else i for i in pending]
+        )
+
+        async with self._gpu_sem:
+            saves = await loop.run_in_executor(
+                self._gpu_executor,
+                self._edit_batch_sync,
+                [prompts[i] for i in miss],
+                decoded,
+                [digests[i] for i in miss],
+                [outdirs[i] for i in miss],
+                num_inference_steps,
+                seed,
+                [keys[i] for i in miss],
+            )
+        if wait:
+            await asyncio.gather(*(asyncio.wrap_future(fut) for _, fut in saves))
+        else:
+
+            def _done(fut: asyncio.Future, index: int):
+                if fut.cancelled() or fut.exception() is None:
+                    return
+                print("[save] failed:", fut.exception())
+                if on_save_error:
+                    on_save_error(index, fut.exception())
+
+            for i, (_, fut) in zip(miss, saves):
+                asyncio.wrap_future(fut).add_done_callback(lambda f, i=i: _done(f, i))
+        for i, (outfile, _) in zip(miss, saves):
+            outfiles[i] = outfile
+        return outfiles
+
+    async def warmup(
+        self,
+        sizes: List[Tuple[int, int]],
+        batch_sizes: List[int],
+        outdir: Path,
+        prompt_buckets: int = 1,
+    ):
+        """Run dummy edits so compiled graphs exist for these shapes before real traffic.
+
+        Each size and batch is traced at the first `prompt_buckets` prompt-length buckets,
+        starting from the one the warm-up prompt falls in.
+        """
+        loop = asyncio.get_running_loop()
+        buckets = range(prompt_buckets if self._prompt_bucket else 1)
+        if self._compiled:
+            # one graph per warmed shape; keep Dynamo from giving up and going eager
+            needed = len(sizes) * len(batch_sizes) * len(buckets)
+            torch._dynamo.config.cache_size_limit = max(
+                torch._dynamo.config.cache_size_limit, needed
+            )
+        for width, height in sizes:
+            image = Image.new("RGB", (width, height))
+            for batch, extra in ((b, e) for b in batch_sizes for e in buckets):
+                try:
+                    saves = await loop.run_in_executor(
+                        self._gpu_executor,
+                        self._edit_batch_sync,
+                        ["warmup"] * batch,
+                        [image] * batch,
+                        [_digest(image)] * batch,
+                        [outdir] * batch,
+                        8,
+                        0,
+                        None,
+                        True,
+                        extra,
+                    )
+                    for outfile in await asyncio.gather(
+                        *(asyncio.wrap_future(fut) for _, fut in saves)
+                    ):
+                        outfile.unlink(missing_ok=True)
+                    print(f"[warmup] {width}x{height} batch={batch} bucket=+{extra} done")
+                except Exception as e:
+                    print(f"[warmup] {width}x{height} batch={batch} bucket=+{extra} failed:", e)
+
+    def close(self):
+        self._gpu_executor.shutdown(wait=True)
+        self._save_pool.shutdown(wait=True)
+
+    # -------------------------
+    # GPU thread
+    # -------------------------
+    def _edit_batch_sync(
+        self,
+        prompts: List[str],
+        images: List[Image.Image],
+        digests: List[str],
+        outdirs: List[Path],
+        num_inference_steps: int,
+        seed: Optional[int],
+        keys: Optional[List[Optional[str]]] = None,
+        capture: bool = False,
+        extra_buckets: int = 0,
+    ) -> List[Tuple[Path, Future]]:
+        keys = keys or [None] * len(images)
+
+        # the pipeline resizes a whole batch to one shape, so group by target size
+        groups: Dict[Tuple[int, int], List[int]] = {}
+        for i, image in enumerate(images):
+            width, height, _ = calculate_dimensions(TARGET_AREA, image.width / image.height)
+            groups.setdefault((width, height), []).append(i)
+
+        saves: List[Optional[Tuple[Path, Future]]] = [None] * len(images)
+        for (width, height), idx in groups.items():
+            group = [self.pipe.image_processor.resize(images[i], height, width) for i in idx]
+            prompt_embeds, prompt_embeds_mask = self._encode_prompts(
+                [prompts[i] for i in idx],
+                group,
+                [(prompts[i], digests[i]) for i in idx],
+                extra_buckets,
+            )
+            # replay compiled graphs for warmed shapes; anything else runs eager rather
+            # than stalling a live request on a fresh trace + capture
+            shape = (width, height, len(idx), prompt_embeds.shape[1])
+            if self._compiled and not capture and shape not in self._graph_shapes:
+                stance = torch.compiler.set_stance("force_eager")
+            else:
+                stance = contextlib.nullcontext()
+            with stance, sdpa_kernel(SDPA_BACKENDS):
+                results = self.pipe(
+                    image=group,
+                    prompt_embeds=prompt_embeds,
+                    prompt_embeds_mask=prompt_embeds_mask,
+                    num_inference_steps=num_inference_steps,
+                    generator=[self._generator(seed) for _ in idx],
+                ).images
+            if capture:
+                self._graph_shapes.add(shape)
+            for i, result in zip(idx, results):
+                saves[i] = self._save(result, outdirs[i], keys[i])
+        return saves
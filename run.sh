@@ -32,9 +32,27 @@ CSV_INBOX="${CSV_INBOX:-$QUEUE_DIR/inbox.csv}"
 # app behavior
 BASE_URL="${BASE_URL:-http://localhost:8080}"
 MAX_CONCURRENCY="${MAX_CONCURRENCY:-1}"
+# webp | jpg | png
+OUTPUT_FORMAT="${OUTPUT_FORMAT:-webp}"
 DEFAULT_LONG_EDGE="${DEFAULT_LONG_EDGE:-1024}"
 USE_4BIT="${USE_4BIT:-1}"
+USE_4BIT_TEXT_ENCODER="${USE_4BIT_TEXT_ENCODER:-0}"
+USE_COMPILE="${USE_COMPILE:-1}"
+USE_CHANNELS_LAST="${USE_CHANNELS_LAST:-1}"
+# auto | resident | text_encoder | model
+OFFLOAD_MODE="${OFFLOAD_MODE:-auto}"
+# diffusers attention backend for the transformer (e.g. flash); empty = native SDPA
+ATTN_BACKEND="${ATTN_BACKEND:-}"
+WARMUP_SIZES="${WARMUP_SIZES:-1024x1024}"
+WARMUP_PROMPT_BUCKETS="${WARMUP_PROMPT_BUCKETS:-2}"
+# keep compiled kernels next to the weights so restarts skip recompilation
+TORCHINDUCTOR_CACHE_DIR="${TORCHINDUCTOR_CACHE_DIR:-/workspace/models/.inductor_cache}"
+# hub downloads (the Lightning LoRA) on the same volume, so restarts don't refetch
+HF_HOME="${HF_HOME:-/workspace/models/.hf}"
+# per-cache cap (CSV row downloads, finished outputs); 0 disables
+MAX_CACHE_BYTES="${MAX_CACHE_BYTES:-10737418240}"
 CSV_SECRET="${CSV_SECRET:-}"
+CSV_SEED="${CSV_SEED:-42}"
 
 # portable nginx
 NGINX_PREFIX="${NGINX_PREFIX:-/opt/ng1}"
@@ -144,7 +162,9 @@ start_uvicorn() {
   cd "$APP_DIR"
   # app env
   export MODEL_ID OUTPUT_DIR QUEUE_DIR CSV_INBOX BASE_URL \
-         MAX_CONCURRENCY DEFAULT_LONG_EDGE USE_4BIT CSV_SECRET
+         MAX_CONCURRENCY DEFAULT_LONG_EDGE USE_4BIT USE_4BIT_TEXT_ENCODER CSV_SECRET CSV_SEED \
+         OUTPUT_FORMAT USE_COMPILE OFFLOAD_MODE ATTN_BACKEND WARMUP_SIZES TORCHINDUCTOR_CACHE_DIR HF_HOME \
+         MAX_CACHE_BYTES USE_CHANNELS_LAST WARMUP_PROMPT_BUCKETS
   log "starting uvicorn on ${UVICORN_HOST}:${UVICORN_PORT}…"
   nohup uvicorn app:app --host "$UVICORN_HOST" --port "$UVICORN_PORT" --log-level info \
     > /tmp/uvicorn.out 2>&1 &